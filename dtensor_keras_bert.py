@@ -83,6 +83,7 @@ python dtensor_bert_train.py --model_size=base --device_type=GPU \
 """
 
 import argparse
+from concurrent import futures
 import os
 import time
 
@@ -95,7 +96,9 @@ ap = argparse.ArgumentParser()
 ap.add_argument(
     '--ckpt_path_prefix',
     default='gs://scottzhu-dtensor-test/bert-small-checkpoint',
-    help='prefix for checkpointing, can be a gs:// path or a local directory')
+    help='prefix for checkpointing, can be a gs:// path or a local directory. '
+         'With multiple clients it must be on storage shared by all clients, '
+         'since only client 0 writes the steps file.')
 ap.add_argument(
     '--data_path',
     default='gs://chenmoney-testing/bert-pretraining-data-512-76/bert-pretraining-data/shard_*.tfrecord',
@@ -145,6 +148,27 @@ ap.add_argument(
     help='Truncates sequence in pretraining and data. 0 means no truncation.'
          'Setting this to a small number (32) drastically increases training '
          'speed.')
+ap.add_argument(
+    '--precision',
+    default='float32',
+    choices=['float32', 'mixed_bfloat16'],
+    help='Keras dtype policy for the model. mixed_bfloat16 keeps the weights '
+         'in float32 but computes in bfloat16, including the one-hot '
+         'embedding matmul.')
+ap.add_argument(
+    '--jit_compile',
+    action='store_true',
+    help='Compile the training step with XLA. Only applies to GPU runs.')
+ap.add_argument(
+    '--gpu_nccl',
+    action='store_true',
+    help='Lower the DTensor collectives to NCCL. Only applies to GPU runs.')
+ap.add_argument(
+    '--steps_per_loop',
+    default=10,
+    type=int,
+    help='Number of training steps run inside a single tf.function call. '
+         'Must be at most 10 and divide the logging interval (100 steps).')
 
 # Parameters for distribution(dtensor)
 
@@ -176,6 +200,7 @@ data_sequence_length = 512
 
 # Training config
 batch_size = 128
+max_steps_per_loop = 10
 training_step = int(256 / batch_size) * 500 * 1000
 
 
@@ -233,13 +258,14 @@ def decode_record(record):
       'next_sentence_labels': tf.io.FixedLenFeature([1], tf.int64),
   }
   # tf.Example only supports tf.int64, but the TPU only supports tf.int32.
-  # So cast all int64 to int32 if needed.
+  # So cast all int64 to int32. This also halves the size of the inputs that
+  # are copied to the devices on every step.
   example = tf.io.parse_single_example(record, name_to_features)
-  # for name in list(example.keys()):
-  #     value = example[name]
-  #     if value.dtype == tf.int64:
-  #         value = tf.cast(value, tf.int32)
-  #     example[name] = value
+  for name in list(example.keys()):
+    value = example[name]
+    if value.dtype == tf.int64:
+      value = tf.cast(value, tf.int32)
+    example[name] = value
   return example
 
 
@@ -255,9 +281,6 @@ def preview_tfrecord(filepath):
       break
     num_total += 1
 
-    example = tf.train.Example()
-    example.ParseFromString(item.numpy())
-
     decoded = decode_record(item)
     input_mask = decoded['input_mask']
     num_valid = tf.reduce_sum(input_mask)
@@ -274,11 +297,40 @@ def remap_input_keys(data_entry):
   return data_entry
 
 
+def get_input_pipeline_params(mesh):
+  """Returns the input pipeline id of this client and the number of pipelines.
+
+  Clients whose local devices hold the same batch shards need the same data,
+  so they share an input pipeline. Each pipeline reads a disjoint part of the
+  data for its contiguous range of batch shards.
+  """
+  local_batch_shards = sorted(
+      {location[BATCH_DIM] for location in mesh.local_device_locations()})
+  num_local_batch_shards = len(local_batch_shards)
+  first_batch_shard = local_batch_shards[0]
+  if (local_batch_shards != list(
+      range(first_batch_shard, first_batch_shard + num_local_batch_shards)) or
+      first_batch_shard % num_local_batch_shards != 0 or
+      mesh.dim_size(BATCH_DIM) % num_local_batch_shards != 0):
+    raise ValueError(f'Expect the local devices to hold an aligned contiguous '
+                     f'range of batch shards, got {local_batch_shards}.')
+  num_pipelines = mesh.dim_size(BATCH_DIM) // num_local_batch_shards
+  pipeline_id = first_batch_shard // num_local_batch_shards
+  return pipeline_id, num_pipelines
+
+
 # Create dataset
-def create_dataset(data_file_path, batch_size, max_sequence_length):
+def create_dataset(data_file_path, batch_size, max_sequence_length,
+                   pipeline_id=0, num_pipelines=1):
 
-  data_files = tf.io.gfile.glob(data_file_path)
+  data_files = sorted(tf.io.gfile.glob(data_file_path))
+  if len(data_files) < num_pipelines:
+    raise ValueError(f'Expect at least {num_pipelines} data files, one per '
+                     f'input pipeline, got {len(data_files)}.')
+  data_files = data_files[pipeline_id::num_pipelines]
 
+  # A fixed number of parallel reads keeps the record order independent of the
+  # host, so the clients sharing an input pipeline read the same batches.
   dataset = tf.data.TFRecordDataset(data_files, num_parallel_reads=10)
   dataset = dataset.map(
       decode_record,
@@ -301,28 +353,55 @@ def create_dataset(data_file_path, batch_size, max_sequence_length):
       num_parallel_calls=tf.data.experimental.AUTOTUNE,
   )
   dataset = dataset.batch(batch_size, drop_remainder=True)
-  dataset = dataset.shuffle(100)
-  dataset = dataset.repeat().prefetch(buffer_size=10)
+  # The explicit seed keeps the shuffle order the same on the clients that
+  # share an input pipeline, regardless of which thread builds the dataset.
+  dataset = dataset.shuffle(100, seed=1337)
+  # Let tf.data size the prefetch buffer, so the next batches are read and
+  # decoded while the current training loop runs.
+  dataset = dataset.repeat().prefetch(tf.data.experimental.AUTOTUNE)
   return dataset
 
 
-def package_inputs_to_dtensor(data, mesh):
-  results = {}
-  for key, inputs in data.items():
-    target_layout = dtensor.Layout.batch_sharded(
-        mesh, batch_dim=BATCH_DIM, rank=len(inputs.shape))
-    replicated_layout = dtensor.Layout.replicated(
-        mesh, rank=len(inputs.shape))
-    d_input = dtensor.copy_to_mesh(inputs, replicated_layout)
-    d_input = dtensor.relayout(d_input, target_layout)
-    results[key] = d_input
+def create_input_packer(element_spec, mesh):
+  """Returns a function that packs a batch of inputs into DTensors.
+
+  The batch read by this client covers the batch shards of its local devices.
+  It is split into one slice per local batch shard, and each local device gets
+  the slice of its shard in the packed batch sharded DTensor.
+
+  The layouts and the device to slice mapping are created once from the
+  dataset `element_spec` and the mesh instead of on every training step.
+  """
+  layouts = {}
+  for key, spec in element_spec.items():
+    layouts[key] = dtensor.Layout.batch_sharded(
+        mesh, batch_dim=BATCH_DIM, rank=len(spec.shape))
+  device_batch_shards = [
+      location[BATCH_DIM] for location in mesh.local_device_locations()
+  ]
+  first_batch_shard = min(device_batch_shards)
+  num_local_batch_shards = len(set(device_batch_shards))
+  device_slices = [shard - first_batch_shard for shard in device_batch_shards]
+
+  def package_inputs_to_dtensor(data):
+    results = {}
+    for key, inputs in data.items():
+      slices = tf.split(inputs, num_local_batch_shards, axis=0)
+      results[key] = dtensor.pack([slices[i] for i in device_slices],
+                                  layouts[key])
+    return results
 
-  return results
+  return package_inputs_to_dtensor
 
 
 # ==================================== Model =================================
 # This is referred from google3/third_party/tensorflow_models/google/dtensor_models/sharding.py
 def create_model_parallel_layout_map(mesh):
+  # For a variable sharded only on the model dim, each device computes the
+  # gradient of its own model shard locally. The gradient still contracts over
+  # the batch, which is sharded on the batch dim, so it is all-reduced over the
+  # batch dim. The optimizer slots share these layouts and are updated per
+  # model shard.
   layout_map = tf.keras.dtensor.experimental.LayoutMap(mesh=mesh)
 
   layout_map['.*word_embeddings.embeddings'] = dtensor.Layout(
@@ -375,9 +454,7 @@ def _gather_indexes(self, sequence_tensor: tf.Tensor, positions: tf.Tensor):
       Masked out sequence tensor of shape (batch_size * num_predictions,
       num_hidden).
   """
-  _, seq_length, width = sequence_tensor.shape.as_list()
-  if seq_length is None:
-    seq_length = tf.shape(sequence_tensor)[1]
+  width = sequence_tensor.shape.as_list()[2]
   if width is None:
     width = tf.shape(sequence_tensor)[2]
 
@@ -401,6 +478,7 @@ def create_bert_model(mesh, model_size, max_sequence_length):
   with tf.keras.dtensor.experimental.layout_map_scope(layout_map=layout_map):
     #!!! We need to fix this. The tf.gather doesn't support SPMD at the moment,
     # we have to force the use_one_hot code path to walkaround the issue.
+    # Under the mixed_bfloat16 policy the one-hot matmul runs in bfloat16.
     embedding = nlp.layers.OnDeviceEmbedding(
         vocab_size=vocab_size,
         embedding_width=hidden_size,
@@ -431,7 +509,6 @@ def create_bert_model(mesh, model_size, max_sequence_length):
 # ==================================== Training ================================
 
 
-@tf.function
 def train_step(bert_pretrainer, data, optimizer, metrics):
   with tf.GradientTape() as tape:
     output_dict = bert_pretrainer(data, training=True)
@@ -464,9 +541,37 @@ def train_step(bert_pretrainer, data, optimizer, metrics):
   metrics['lm_accuracy'].update_state(data['masked_lm_ids'], lm_preds,
                                       data['masked_lm_weights'])
   metrics['nsp_accuracy'].update_state(data['next_sentence_labels'], nsp_preds)
+  metrics['mean_loss'].update_state(loss)
   return {'loss': loss, 'lm_loss': lm_loss, 'nsp_loss': nsp_loss}
 
 
+@tf.function(jit_compile=False, reduce_retracing=True)
+def train_multiple_steps(bert_pretrainer, batches, train_step_fn, optimizer,
+                         metrics):
+  """Runs a training step on each of the packed `batches` in one tf.function.
+
+  This amortizes the per-call dispatch overhead of `train_step_fn` over the
+  batches. The batches are still read and packed eagerly by the caller, and
+  the Python loop is unrolled when traced, so the graph holds one copy of the
+  training step per batch; `max_steps_per_loop` bounds the tracing cost.
+  Returns the losses of the last step.
+  """
+  for data in batches:
+    losses = train_step_fn(bert_pretrainer, data, optimizer, metrics)
+  return losses
+
+
+def create_train_step(device_type, jit_compile):
+  # XLA fuses the embedding matmul, layer norms and softmax into a few
+  # kernels on GPU. It is only enabled there.
+  # The step also takes the model, optimizer and metrics, so it can not have
+  # an input_signature; reduce_retracing generalizes the input shapes instead.
+  return tf.function(
+      train_step,
+      jit_compile=jit_compile and device_type == 'GPU',
+      reduce_retracing=True)
+
+
 class LinearDecayWithWarmup(tf.keras.optimizers.schedules.LearningRateSchedule):
   """
     A learning rate schedule with linear warmup and decay.
@@ -522,8 +627,15 @@ def create_metrics(mesh):
       name='lm_accuracy', mesh=mesh)
   nsp_accuracy = tf.keras.metrics.SparseCategoricalAccuracy(
       name='nsp_accuracy', mesh=mesh)
-
-  return {'lm_accuracy': lm_accuracy, 'nsp_accuracy': nsp_accuracy}
+  # Averages the loss over the logging interval on device, so it is only read
+  # back to the host when logging.
+  mean_loss = tf.keras.metrics.Mean(name='mean_loss', mesh=mesh)
+
+  return {
+      'lm_accuracy': lm_accuracy,
+      'nsp_accuracy': nsp_accuracy,
+      'mean_loss': mean_loss,
+  }
 
 
 # ==================================== Checkpoint =================================
@@ -560,11 +672,17 @@ def config_checkpoint(checkpoint_dir):
   else:
     start_step = 0
     print('start up step: ', start_step)
-    with tf.io.gfile.GFile(step_file_path, 'w') as f:
-      f.write(str(start_step))
+    if dtensor.client_id() == 0:
+      write_checkpoint_step(checkpoint_dir, start_step)
   return start_step
 
 
+def write_checkpoint_step(checkpoint_dir, step):
+  step_file_path = os.path.join(checkpoint_dir, 'steps')
+  with tf.io.gfile.GFile(step_file_path, 'w') as f:
+    f.write(str(step))
+
+
 # ============================ Tensorboard =======================================
 def config_tensorboard(logging_dir_path):
   import datetime
@@ -601,6 +719,10 @@ def main():
   configure_virtual_devices(args.num_global_devices // dtensor.num_clients(), 'CPU')
 
   if args.device_type == 'GPU':
+    if args.gpu_nccl:
+      # Lower the GPU collectives to NCCL, which picks ring or tree all-reduce
+      # based on the topology, instead of the generic collective ops.
+      os.environ['DTENSOR_GPU_USE_NCCL_COMMUNICATION'] = '1'
     dtensor.initialize_multi_client()
   elif args.device_type == 'TPU':
     tf.experimental.dtensor.initialize_tpu_system()
@@ -639,16 +761,39 @@ def main():
 
   start_step = config_checkpoint(args.ckpt_path_prefix)
 
+  # Every client initializes its own shards of the variables, so all clients
+  # need the same random seed. The initializers are cloned across layers by
+  # the BERT model, so seeding them individually would give every layer the
+  # same initial weights.
   tf.keras.utils.set_random_seed(1337)
   tf.keras.backend.experimental.enable_tf_random_generator()
-
-  model = create_bert_model(
-      mesh, model_size=args.model_size, max_sequence_length=max_sequence_length)
-  metrics = create_metrics(mesh)
-  optimizer = create_optimizer(mesh)
-  optimizer.iterations.assign(start_step)
-  dataset = create_dataset(
-      args.data_path, batch_size, max_sequence_length=max_sequence_length)
+  tf.keras.mixed_precision.set_global_policy(args.precision)
+
+  # Each client only reads the part of the global batch for its local devices.
+  pipeline_id, num_pipelines = get_input_pipeline_params(mesh)
+  print(f'Input pipeline {pipeline_id} of {num_pipelines}')
+  if batch_size % mesh.dim_size(BATCH_DIM) != 0:
+    raise ValueError(f'Batch size {batch_size} is not divisible by the number '
+                     f'of batch shards {mesh.dim_size(BATCH_DIM)}.')
+
+  # The dataset does not depend on the model, so it is created (including the
+  # listing of the data files) in the background while the model is built.
+  with futures.ThreadPoolExecutor(max_workers=1) as executor:
+    dataset_future = executor.submit(
+        create_dataset,
+        args.data_path,
+        batch_size // num_pipelines,
+        max_sequence_length=max_sequence_length,
+        pipeline_id=pipeline_id,
+        num_pipelines=num_pipelines)
+
+    model = create_bert_model(
+        mesh, model_size=args.model_size,
+        max_sequence_length=max_sequence_length)
+    metrics = create_metrics(mesh)
+    optimizer = create_optimizer(mesh)
+    optimizer.iterations.assign(start_step)
+    dataset = dataset_future.result()
   tensorboard_path = args.tensorboard_path
   tb_dir = os.path.join(
       tensorboard_path,
@@ -669,52 +814,90 @@ def main():
 
   steps = start_step
   logging_steps = 100
-
+  steps_per_loop = args.steps_per_loop
+  if not 0 < steps_per_loop <= max_steps_per_loop:
+    raise ValueError(f'steps_per_loop ({steps_per_loop}) must be between 1 '
+                     f'and {max_steps_per_loop}.')
+  if logging_steps % steps_per_loop != 0:
+    raise ValueError(f'steps_per_loop ({steps_per_loop}) must divide the '
+                     f'logging interval ({logging_steps}).')
+
+  is_chief = dtensor.client_id() == 0
+
+  # The steps file is a small blocking write (usually to GCS) that does not
+  # depend on the model, so it is written in the background while training
+  # continues. Only client 0 writes it; all clients read it on startup, so
+  # --ckpt_path_prefix must be on shared storage with multiple clients.
+  step_file_executor = futures.ThreadPoolExecutor(max_workers=1)
+  step_file_future = None
+
+  pack_fn = create_input_packer(dataset.element_spec, mesh)
+  train_step_fn = create_train_step(args.device_type, args.jit_compile)
+  iterator = iter(dataset)
   start_time = time.monotonic()
-  for data in dataset:
-    steps += 1
+  while steps < training_step:
+    steps += steps_per_loop
+    is_logging_step = steps % logging_steps == 0
+    is_trace_step = is_logging_step and enable_profile_trace
 
-    # Trace the performance log for 1 step
-    if steps % logging_steps == 0 and enable_profile_trace:
+    # Trace the performance log for 1 training loop
+    if is_trace_step:
       start_trace(tb_dir, mesh)
 
-    data = package_inputs_to_dtensor(data, mesh)
-    losses = train_step(model, data, optimizer, metrics)
+    # The batches are read and packed eagerly, since the tf.data iterator can
+    # not feed DTensor ops inside a tf.function.
+    batches = [pack_fn(next(iterator)) for _ in range(steps_per_loop)]
+    losses = train_multiple_steps(model, batches, train_step_fn, optimizer,
+                                  metrics)
 
-    if steps % logging_steps == 0 and enable_profile_trace:
+    if is_trace_step:
       end_trace(mesh)
 
-    if steps % logging_steps == 0:
+    if is_logging_step:
       dtensor.barrier(mesh)
       end_time = time.monotonic()
-      print('===========================')
-      print(f'step: {steps}')
-      print(f'Took: {end_time - start_time}')
-      print(f'Steps per second: {logging_steps / (end_time - start_time)}')
+      # The values are computed on every client, but the report is printed
+      # once, by client 0, as a single write.
+      log_lines = [
+          '===========================',
+          f'step: {steps}',
+          f'Took: {end_time - start_time}',
+          f'Steps per second: {logging_steps / (end_time - start_time)}',
+      ]
+      # Each value is fetched to the host once and reused for both the console
+      # and the summary, instead of evaluating the DTensor twice.
       with train_summary_writer.as_default():
         for name, loss in losses.items():
-          print(f'{name}: {loss.numpy()}')
-          tf.summary.scalar(name, tf.math.reduce_mean(loss), step=steps)
+          loss_value = loss.numpy()
+          log_lines.append(f'{name}: {loss_value}')
+          tf.summary.scalar(name, loss_value, step=steps)
 
         for name, metric in metrics.items():
-          print(f'{name}: {metric.result().numpy()}')
-          tf.summary.scalar(name, metric.result(), step=steps)
+          metric_value = metric.result().numpy()
+          log_lines.append(f'{name}: {metric_value}')
+          tf.summary.scalar(name, metric_value, step=steps)
           metric.reset_state()
-        print(f'current learning rate: {optimizer.lr.numpy()}')
-        tf.summary.scalar('learning rate', optimizer.lr, step=steps)
+        learning_rate = optimizer.lr.numpy()
+        log_lines.append(f'current learning rate: {learning_rate}')
+        tf.summary.scalar('learning rate', learning_rate, step=steps)
+      if is_chief:
+        print('\n'.join(log_lines))
 
       # Saving checkpoint
       cpt = dtensor.DTensorCheckpoint(mesh=mesh, root=model)
       cpt.save(os.path.join(args.ckpt_path_prefix, 'ckpt'))
       # Write down steps
-      step_file_path = os.path.join(args.ckpt_path_prefix, 'steps')
-      with tf.io.gfile.GFile(step_file_path, 'w') as f:
-        f.write(str(steps))
+      if is_chief:
+        if step_file_future is not None:
+          step_file_future.result()
+        step_file_future = step_file_executor.submit(
+            write_checkpoint_step, args.ckpt_path_prefix, steps)
 
       start_time = time.monotonic()
 
-    if steps >= training_step:
-      break
+  if step_file_future is not None:
+    step_file_future.result()
+  step_file_executor.shutdown()
 
 
 if __name__ == '__main__':